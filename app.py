@@ -1,6 +1,8 @@
-from flask import Flask, render_template, jsonify
+from flask import Flask, render_template, jsonify, request
 from osm_data import update_roads_from_osm
+from road_index import get_road_index, rebuild_road_index
 import json
+import math
 import os
 from database import (
     init_database, get_cached_roads, cleanup_expired_cache,
@@ -9,14 +11,28 @@ from database import (
 
 app = Flask(__name__)
 
+# Upper bounds for nearest-road queries
+MAX_NEAREST_K = 50
+MAX_BATCH_POINTS = 10000
+
 # Initialize database on startup
+database_ready = False
 try:
     init_database()
     cleanup_expired_cache()
+    database_ready = True
     print("Database initialized successfully")
 except Exception as e:
     print(f"Database initialization failed: {e}")
 
+# Build the nearest-road index up front so the first query doesn't pay for it.
+# At most one database attempt, to keep worker startup short; if it falls
+# back to the static file, get_road_index keeps retrying the database later.
+try:
+    rebuild_road_index(max_retries=1 if database_ready else 0)
+except Exception as e:
+    print(f"Road index build failed: {e}")
+
 # Define the main route to serve the HTML page
 @app.route('/')
 def index():
@@ -131,5 +147,80 @@ def update_data():
             "message": str(e)
         }), 500
 
+def parse_point(lat, lon):
+    """Parse a lat/lon pair, rejecting non-finite or out of range values"""
+    lat, lon = float(lat), float(lon)
+    if not (math.isfinite(lat) and math.isfinite(lon)):
+        raise ValueError("lat and lon must be finite numbers")
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError("lat must be within [-90, 90] and lon within [-180, 180]")
+    return lat, lon
+
+def parse_nearest_options(source):
+    """Parse k and max_distance from query args or a JSON body"""
+    k = source.get('k', 1)
+    # JSON bodies can carry floats and booleans, which int() would silently accept
+    if isinstance(k, bool) or not isinstance(k, (int, str)):
+        raise ValueError("k must be an integer")
+    k = int(k)
+    if not 1 <= k <= MAX_NEAREST_K:
+        raise ValueError(f"k must be between 1 and {MAX_NEAREST_K}")
+    max_distance = source.get('max_distance')
+    if max_distance is not None:
+        if isinstance(max_distance, bool):
+            raise ValueError("max_distance must be a number")
+        max_distance = float(max_distance)
+        if not math.isfinite(max_distance) or max_distance <= 0:
+            raise ValueError("max_distance must be a positive finite number")
+    return k, max_distance
+
+# Define API endpoint to find the roads nearest to a point
+@app.route('/nearest')
+def nearest_roads():
+    """Find the k nearest roads to a lat/lon point"""
+    try:
+        lat, lon = parse_point(request.args['lat'], request.args['lon'])
+        k, max_distance = parse_nearest_options(request.args)
+    except (KeyError, TypeError, ValueError, OverflowError) as e:
+        return jsonify({"error": f"Invalid query parameters: {e}"}), 400
+
+    try:
+        matches = get_road_index().query(lat, lon, k=k, max_distance=max_distance)
+        return jsonify({"lat": lat, "lon": lon, "matches": matches})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Define batch API endpoint to snap many points to their nearest roads
+@app.route('/nearest/batch', methods=['POST'])
+def nearest_roads_batch():
+    """Find the k nearest roads for each point in a JSON list"""
+    body = request.get_json(silent=True)
+    try:
+        if not isinstance(body, dict):
+            raise ValueError("body must be a JSON object")
+        points = body['points']
+        if len(points) > MAX_BATCH_POINTS:
+            raise ValueError(f"at most {MAX_BATCH_POINTS} points per request")
+        # Accept both {"lat": .., "lon": ..} objects and [lat, lon] pairs
+        coords = [
+            parse_point(p['lat'], p['lon']) if isinstance(p, dict) else parse_point(p[0], p[1])
+            for p in points
+        ]
+        k, max_distance = parse_nearest_options(body)
+    except (KeyError, IndexError, TypeError, ValueError, OverflowError) as e:
+        return jsonify({"error": f"Invalid request body: {e}"}), 400
+
+    try:
+        lats = [lat for lat, _ in coords]
+        lons = [lon for _, lon in coords]
+        matches = get_road_index().query_many(lats, lons, k=k, max_distance=max_distance)
+        results = [
+            {"lat": lat, "lon": lon, "matches": point_matches}
+            for (lat, lon), point_matches in zip(coords, matches)
+        ]
+        return jsonify({"results": results})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=4000, debug=True)
@@ -270,4 +270,34 @@ def search_roads_by_name(search_term, limit=10):
             'limit': limit
         })
 
-        return [{'type': row[0], 'name': row[1], 'geometry': json.loads(row[2])} for row in result]
\ No newline at end of file
+        return [{'type': row[0], 'name': row[1], 'geometry': json.loads(row[2])} for row in result]
+
+def get_all_roads(max_retries=3):
+    """Get every stored road with its parsed geometry, with retry logic for sleeping database"""
+    import time
+    retry_delay = 2
+
+    for attempt in range(max_retries):
+        try:
+            with engine.connect() as conn:
+                result = conn.execute(text("""
+                    SELECT osm_id, road_type, name, geometry
+                    FROM roads
+                """))
+
+                return [{
+                    'osm_id': row[0],
+                    'road_type': row[1],
+                    'name': row[2],
+                    'geometry': json.loads(row[3])
+                } for row in result]
+
+        except Exception as e:
+            print(f"Database connection attempt {attempt + 1} failed: {e}")
+            if attempt < max_retries - 1:
+                print(f"Retrying in {retry_delay} seconds...")
+                time.sleep(retry_delay)
+                retry_delay *= 2  # Exponential backoff
+            else:
+                print("All database connection attempts failed")
+                raise e
@@ -3,6 +3,7 @@ import requests
 import json
 import time
 from database import save_road_data, get_cached_api_response, cache_api_response
+from road_index import rebuild_road_index
 
 def fetch_osm_roads(road_type, bbox_str, timeout=30):
     """
@@ -122,6 +123,15 @@ def update_roads_from_osm(bbox_str="41.4,-83.8,41.9,-83.2", road_types=None):
             stats['errors'].append(error_msg)
             print(error_msg)
 
+    # Rebuild the in-memory road index so nearest-road queries see the new data
+    if stats['total_saved']:
+        try:
+            stats['indexed_segments'] = len(rebuild_road_index())
+        except Exception as e:
+            error_msg = f"Error rebuilding road index: {str(e)}"
+            stats['errors'].append(error_msg)
+            print(error_msg)
+
     return stats
 
 print("OSM roads update_roads_from_osm loaded successfully")
@@ -0,0 +1,509 @@
+import json
+import math
+import os
+import threading
+import time
+import numpy as np
+
+# Mean Earth radius in meters, used for the local equirectangular projection
+EARTH_RADIUS_M = 6371008.8
+
+# Side length of a grid cell in projected meters
+DEFAULT_CELL_SIZE_M = 500.0
+
+# Cell radii of the blocks batch queries search before falling back to query()
+BATCH_BLOCK_RADII = (1, 3, 8)
+
+# Points measured together per batch chunk, bounding the size of the pair arrays
+BATCH_CHUNK_POINTS = 1024
+
+# Rings query() walks before measuring every segment in one pass instead
+MAX_QUERY_RINGS = 16
+
+# Cap on the number of grid cells; the cell size grows to stay under it
+MAX_GRID_CELLS = 1 << 22
+
+# Seconds between attempts to replace a static-file index with database roads
+STATIC_INDEX_RETRY_SECONDS = 60
+
+STATIC_ROADS_PATH = os.path.join('static', 'data', 'toledo_roads.geojson')
+
+
+class RoadSegmentIndex:
+    """
+    In-memory uniform grid over road segments for nearest-road queries
+
+    Road polylines are split into straight segments and projected to local
+    meters around the mean latitude of the data, which is accurate enough at
+    city scale. Each segment is bucketed into the grid cells along it, so a
+    query only measures the segments in the cells around it.
+    The buckets are stored as flat arrays (cell offsets into a segment id
+    array) so whole batches of points can be measured in one vectorized pass.
+    """
+
+    def __init__(self, roads, cell_size=DEFAULT_CELL_SIZE_M):
+        """
+        Build the index
+
+        Args:
+            roads: List of dicts with osm_id, name, road_type and geometry,
+                where geometry is a list of {'lat': ..., 'lon': ...} nodes
+            cell_size: Grid cell size in meters
+        """
+        self.cell_size = float(cell_size)
+        self.roads = []
+
+        lats, lons, road_ids, seg_mask = [], [], [], []
+        for road in roads:
+            geometry = road.get('geometry') or []
+            if len(geometry) < 2:  # Need at least two points for a segment
+                continue
+            road_id = len(self.roads)
+            self.roads.append({
+                'osm_id': road.get('osm_id'),
+                'name': road.get('name') or '',
+                'road_type': road.get('road_type')
+            })
+            for i, node in enumerate(geometry):
+                lats.append(node['lat'])
+                lons.append(node['lon'])
+                road_ids.append(road_id)
+                # A segment starts at every node except the last of each road
+                seg_mask.append(i < len(geometry) - 1)
+
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        self.lat0 = float(lats.mean()) if lats.size else 0.0
+        self.lon0 = float(lons.mean()) if lons.size else 0.0
+        self._kx = EARTH_RADIUS_M * math.radians(1.0) * math.cos(math.radians(self.lat0))
+        self._ky = EARTH_RADIUS_M * math.radians(1.0)
+
+        x, y = self._project(lats, lons)
+        starts = np.flatnonzero(np.asarray(seg_mask, dtype=bool))
+        self.ax, self.ay = x[starts], y[starts]
+        self.bx, self.by = x[starts + 1], y[starts + 1]
+        self.seg_road = np.asarray(road_ids, dtype=np.int64)[starts]
+
+        # Precompute segment vectors for the point-to-segment projection
+        self.dx = self.bx - self.ax
+        self.dy = self.by - self.ay
+        self.len2 = self.dx * self.dx + self.dy * self.dy
+        self.len2[self.len2 == 0] = 1.0  # Degenerate segments: t is clipped to 0
+
+        self._build_grid()
+
+    def __len__(self):
+        return int(self.seg_road.size)
+
+    def _project(self, lat, lon):
+        """Project lat/lon degrees to local x/y meters"""
+        return (lon - self.lon0) * self._kx, (lat - self.lat0) * self._ky
+
+    def _unproject(self, x, y):
+        """Project local x/y meters back to lat/lon degrees"""
+        return y / self._ky + self.lat0, x / self._kx + self.lon0
+
+    def _build_grid(self):
+        """Bucket each segment into the grid cells along it"""
+        self._origin = (0, 0)
+        self._shape = (0, 0)
+        self._cell_start = np.zeros(1, dtype=np.int64)
+        self._cell_segs = np.zeros(0, dtype=np.int64)
+        if not len(self):
+            return
+
+        min_x = np.minimum(self.ax, self.bx)
+        max_x = np.maximum(self.ax, self.bx)
+        min_y = np.minimum(self.ay, self.by)
+        max_y = np.maximum(self.ay, self.by)
+        # Grow the cells for very large extents to keep the grid bounded
+        span = (max_x.max() - min_x.min()) * (max_y.max() - min_y.min())
+        self.cell_size = max(self.cell_size, math.sqrt(span / MAX_GRID_CELLS))
+
+        s = self.cell_size
+        self._origin = (int(np.floor(min_x.min() / s)), int(np.floor(min_y.min() / s)))
+        self._shape = (
+            int(np.floor(max_x.max() / s)) - self._origin[0] + 1,
+            int(np.floor(max_y.max() / s)) - self._origin[1] + 1
+        )
+
+        # Split segments into pieces no longer than a cell, so each piece's
+        # bounding box covers at most 2x2 cells. Bucketing whole segments by
+        # their bounding box would grow quadratically for long diagonals.
+        pieces = np.maximum(np.ceil(np.hypot(self.dx, self.dy) / s), 1).astype(np.int64)
+        seg_of_piece = np.repeat(np.arange(len(self)), pieces)
+        step = np.arange(seg_of_piece.size) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+        t0 = step / pieces[seg_of_piece]
+        t1 = (step + 1) / pieces[seg_of_piece]
+        ax, ay = self.ax[seg_of_piece], self.ay[seg_of_piece]
+        dx, dy = self.dx[seg_of_piece], self.dy[seg_of_piece]
+        ix0 = np.floor((ax + np.minimum(t0 * dx, t1 * dx)) / s).astype(np.int64)
+        ix1 = np.floor((ax + np.maximum(t0 * dx, t1 * dx)) / s).astype(np.int64)
+        iy0 = np.floor((ay + np.minimum(t0 * dy, t1 * dy)) / s).astype(np.int64)
+        iy1 = np.floor((ay + np.maximum(t0 * dy, t1 * dy)) / s).astype(np.int64)
+
+        # Expand each piece into one (cell, segment) pair per covered cell
+        heights = iy1 - iy0 + 1
+        counts = (ix1 - ix0 + 1) * heights
+        rows = np.repeat(np.arange(seg_of_piece.size), counts)
+        step = np.arange(rows.size) - np.repeat(np.cumsum(counts) - counts, counts)
+        ix = ix0[rows] + step // heights[rows]
+        iy = iy0[rows] + step % heights[rows]
+        cells = (ix - self._origin[0]) * self._shape[1] + (iy - self._origin[1])
+
+        # Neighbouring pieces share cells; keep each (cell, segment) pair once
+        pairs = np.unique(cells * len(self) + seg_of_piece[rows])
+        cells = pairs // len(self)
+        self._cell_segs = pairs % len(self)
+        self._cell_start = np.zeros(self._shape[0] * self._shape[1] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=self._shape[0] * self._shape[1]), out=self._cell_start[1:])
+
+    def _ring(self, cx, cy, r):
+        """Collect segment ids from the cells exactly r cells away from (cx, cy)"""
+        nx, ny = self._shape
+        # Only walk the part of the ring that overlaps the grid
+        x0, x1 = max(cx - r, 0), min(cx + r, nx - 1)
+        y0, y1 = max(cy - r + 1, 0), min(cy + r - 1, ny - 1)
+        cells = []
+        for iy in (cy - r, cy + r) if r else (cy,):
+            if 0 <= iy < ny:
+                cells += [ix * ny + iy for ix in range(x0, x1 + 1)]
+        for ix in (cx - r, cx + r) if r else ():
+            if 0 <= ix < nx:
+                cells += [ix * ny + iy for iy in range(y0, y1 + 1)]
+        start, segs = self._cell_start, self._cell_segs
+        return [segs[start[c]:start[c + 1]] for c in cells if start[c] != start[c + 1]]
+
+    def _ring_bounds(self, cx, cy):
+        """Ring radii between which cells can hold segments"""
+        nx, ny = self._shape
+        inner = max(-cx, cx - nx + 1, -cy, cy - ny + 1, 0)
+        outer = max(cx, nx - 1 - cx, cy, ny - 1 - cy, 0)
+        return inner, outer
+
+    def _locate(self, px, py):
+        """Grid cell of projected points, plus their distance to the cell edge"""
+        s = self.cell_size
+        fx = np.floor(px / s)
+        fy = np.floor(py / s)
+        edge = np.minimum.reduce([px - fx * s, (fx + 1) * s - px, py - fy * s, (fy + 1) * s - py])
+        return fx.astype(np.int64) - self._origin[0], fy.astype(np.int64) - self._origin[1], edge
+
+    def query(self, lat, lon, k=1, max_distance=None):
+        """
+        Find the k nearest roads to a point
+
+        Args:
+            lat: Latitude of the query point
+            lon: Longitude of the query point
+            k: Number of distinct roads to return
+            max_distance: Optional search radius in meters
+
+        Returns:
+            List of matches ordered by distance, each with the road's osm_id,
+            name, road_type, distance in meters and the snapped point
+        """
+        if not len(self) or k < 1:
+            return []
+
+        s = self.cell_size
+        px, py = self._project(float(lat), float(lon))
+        if not (math.isfinite(px) and math.isfinite(py)):
+            return []
+        cx, cy, edge = self._locate(np.array([px]), np.array([py]))
+        cx, cy, edge = int(cx[0]), int(cy[0]), float(edge[0])
+        r, max_ring = self._ring_bounds(cx, cy)
+        if max_distance is not None:
+            max_ring = min(max_ring, int(math.ceil(max_distance / s)))
+
+        measured = []
+        best = None
+        while r <= max_ring:
+            # Far from the data, one full scan beats walking ring after ring
+            if r > MAX_QUERY_RINGS:
+                best = self._nearest_roads(*self._measure(px, py, np.arange(len(self))), k)
+                break
+            chunks = self._ring(cx, cy, r)
+            if chunks:
+                measured.append(self._measure(px, py, np.concatenate(chunks)))
+                best = self._nearest_roads(*(np.concatenate(arrays) for arrays in zip(*measured)), k)
+            # Anything outside the searched square is at least this far away
+            if best is not None and len(best[0]) == k and best[1][-1] <= edge + r * s:
+                break
+            r += 1
+
+        if best is None:
+            return []
+        segs, dist, qx, qy = best
+        snap_lat, snap_lon = self._unproject(qx, qy)
+        return self._matches(segs.tolist(), dist.tolist(), snap_lat.tolist(), snap_lon.tolist(), max_distance)
+
+    def query_many(self, lats, lons, k=1, max_distance=None):
+        """
+        Find the k nearest roads for many points at once
+
+        Points are measured together against the block of cells around
+        them, widening the block for the points whose answer it cannot
+        prove. The few left after that (sparse areas, points off the grid)
+        fall back to query().
+
+        Args:
+            lats: Sequence of latitudes
+            lons: Sequence of longitudes
+            k: Number of distinct roads to return per point
+            max_distance: Optional search radius in meters
+
+        Returns:
+            List with one list of matches per point, as returned by query()
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        if not len(self) or k < 1:
+            return [[] for _ in range(lats.size)]
+
+        results = []
+        for start in range(0, lats.size, BATCH_CHUNK_POINTS):
+            chunk = slice(start, start + BATCH_CHUNK_POINTS)
+            results += self._query_chunk(lats[chunk], lons[chunk], k, max_distance)
+        return results
+
+    def _query_chunk(self, lats, lons, k, max_distance):
+        """Answer one chunk of a batch query, widening the block as needed"""
+        results = [None] * lats.size
+        px, py = self._project(lats, lons)
+        cx, cy, edge = self._locate(px, py)
+        pending = np.arange(lats.size)
+        for radius in BATCH_BLOCK_RADII:
+            if not pending.size:
+                break
+            solved, offsets, segs, dist, qx, qy = self._query_block(
+                px[pending], py[pending], cx[pending], cy[pending], edge[pending], radius, k, max_distance
+            )
+            snap_lat, snap_lon = self._unproject(qx, qy)
+            segs, dist, snap_lat, snap_lon = segs.tolist(), dist.tolist(), snap_lat.tolist(), snap_lon.tolist()
+            offsets = offsets.tolist()
+            for j in np.flatnonzero(solved).tolist():
+                rows = slice(offsets[j], offsets[j + 1])
+                results[pending[j]] = self._matches(segs[rows], dist[rows], snap_lat[rows], snap_lon[rows], max_distance)
+            pending = pending[~solved]
+
+        for i in pending.tolist():
+            results[i] = self.query(lats[i], lons[i], k=k, max_distance=max_distance)
+        return results
+
+    def _query_block(self, px, py, cx, cy, edge, radius, k, max_distance):
+        """
+        Measure points against every segment within `radius` cells of them
+
+        Returns:
+            Tuple of (solved mask, per-point row offsets, segment ids,
+            distances, snapped x, snapped y); rows offsets[i]:offsets[i + 1]
+            hold point i's closest roads ordered by distance
+        """
+        s = self.cell_size
+        nx, ny = self._shape
+        n = px.size
+
+        # Segment ranges of the cell block around every point
+        span = np.arange(-radius, radius + 1)
+        ix = (cx[:, None] + np.repeat(span, span.size)).ravel()
+        iy = (cy[:, None] + np.tile(span, span.size)).ravel()
+        valid = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+        cells = np.where(valid, ix * ny + iy, 0)
+        lo = np.where(valid, self._cell_start[cells], 0)
+        counts = np.where(valid, self._cell_start[cells + 1], 0) - lo
+
+        # One row per (point, candidate segment) pair, grouped by point
+        pt = np.repeat(np.repeat(np.arange(n), span.size ** 2), counts)
+        rows = np.arange(counts.sum()) + np.repeat(lo - (np.cumsum(counts) - counts), counts)
+        segs, dist, qx, qy = self._measure(px[pt], py[pt], self._cell_segs[rows])
+
+        # Ties (roads meeting at a shared node) break on road then segment,
+        # the same order _nearest_roads uses
+        road = self.seg_road[segs]
+        if k == 1:
+            # Rows are already grouped by point, so a segmented min suffices
+            found = np.bincount(pt, minlength=n).clip(max=1)
+            starts = np.concatenate(([0], np.cumsum(np.bincount(pt, minlength=n))))[:-1]
+            nearest = np.full(n, np.inf)
+            nearest[found > 0] = np.minimum.reduceat(dist, starts[found > 0])
+            hit = np.flatnonzero(dist == nearest[pt])
+            hit = hit[np.lexsort((segs[hit], road[hit], pt[hit]))]
+            _, first = np.unique(pt[hit], return_index=True)
+            order = hit[first]
+        else:
+            # Closest segment per (point, road), then the k closest roads per point
+            order = np.lexsort((segs, dist, road, pt))
+            first = np.ones(order.size, dtype=bool)
+            first[1:] = (pt[order][1:] != pt[order][:-1]) | (road[order][1:] != road[order][:-1])
+            order = order[first]
+            order = order[np.lexsort((road[order], dist[order], pt[order]))]
+            rank = np.arange(order.size) - np.searchsorted(pt[order], pt[order])
+            order = order[rank < k]
+            found = np.bincount(pt[order], minlength=n)
+
+        offsets = np.concatenate(([0], np.cumsum(found)))
+        kth = np.full(n, np.inf)
+        kth[found > 0] = dist[order[offsets[1:][found > 0] - 1]]
+        # Nothing outside the block can be closer than this
+        reach = edge + radius * s
+        solved = (found == k) & (kth <= reach)
+        if max_distance is not None:
+            solved |= reach >= max_distance
+        return solved, offsets, segs[order], dist[order], qx[order], qy[order]
+
+    def _measure(self, px, py, segs):
+        """
+        Measure points against candidate segments
+
+        Returns:
+            Tuple of (segment ids, distances, snapped x, snapped y) arrays
+        """
+        ax, ay = self.ax[segs], self.ay[segs]
+        dx, dy = self.dx[segs], self.dy[segs]
+        t = np.clip(((px - ax) * dx + (py - ay) * dy) / self.len2[segs], 0.0, 1.0)
+        qx = ax + t * dx
+        qy = ay + t * dy
+        return segs, np.hypot(px - qx, py - qy), qx, qy
+
+    def _nearest_roads(self, segs, dist, qx, qy, k):
+        """
+        Keep the closest segment of each road, for up to k roads ordered by
+        distance, then road, then segment
+        """
+        road = self.seg_road[segs]
+        order = np.lexsort((segs, road, dist))
+        if k == 1:
+            keep = order[:1]
+        else:
+            keep, seen = [], set()
+            for i, road_id in zip(order.tolist(), road[order].tolist()):
+                if road_id not in seen:
+                    seen.add(road_id)
+                    keep.append(i)
+                    if len(keep) == k:
+                        break
+        return segs[keep], dist[keep], qx[keep], qy[keep]
+
+    def _matches(self, segs, dist, snap_lat, snap_lon, max_distance=None):
+        """Format measured segments as match dicts, dropping any past max_distance"""
+        matches = []
+        for seg, d, lat, lon in zip(segs, dist, snap_lat, snap_lon):
+            if max_distance is not None and d > max_distance:
+                break
+            road = self.roads[self.seg_road[seg]]
+            matches.append({
+                'osm_id': road['osm_id'],
+                'name': road['name'],
+                'road_type': road['road_type'],
+                'distance_m': round(d, 2),
+                'point': {'lat': lat, 'lon': lon}
+            })
+        return matches
+
+
+def load_roads(max_retries=3):
+    """
+    Load road geometries from the database, falling back to the static file
+
+    Args:
+        max_retries: Database attempts before falling back, 0 to skip the database
+
+    Returns:
+        Tuple of (roads, source) where source is 'database' or 'static'
+    """
+    # Imported here so the index itself can be built without a database
+    from database import get_all_roads
+
+    if max_retries > 0:
+        try:
+            roads = get_all_roads(max_retries=max_retries)
+            if roads:
+                print(f"Loaded {len(roads)} roads from database for road index")
+                return roads, 'database'
+            print("Database returned no roads for road index, falling back to static file")
+        except Exception as e:
+            print(f"Error loading roads for road index: {e}")
+
+    if not os.path.exists(STATIC_ROADS_PATH):
+        return [], 'static'
+
+    with open(STATIC_ROADS_PATH, 'r') as f:
+        data = json.load(f)
+
+    roads = []
+    for feature in data.get('features', []):
+        geometry = feature.get('geometry') or {}
+        if geometry.get('type') != 'LineString':
+            continue
+        properties = feature.get('properties', {})
+        roads.append({
+            'osm_id': properties.get('osm_id'),
+            'road_type': properties.get('road_type') or properties.get('highway'),
+            'name': properties.get('name'),
+            'geometry': [{'lat': lat, 'lon': lon} for lon, lat in geometry['coordinates']]
+        })
+    print(f"Loaded {len(roads)} roads from static file for road index")
+    return roads, 'static'
+
+
+_road_index = None
+_road_index_source = None
+_road_index_built_at = 0.0
+_road_index_lock = threading.Lock()
+# Held while loading and publishing, so a build can't be overwritten by an
+# older one that read the roads before it did
+_road_index_build_lock = threading.Lock()
+_road_index_retry_lock = threading.Lock()
+
+
+def _build_road_index(max_retries=3):
+    """Load, build and publish the shared index; callers hold the build lock"""
+    global _road_index, _road_index_source, _road_index_built_at
+    # Build off to the side so queries keep using the old index meanwhile
+    roads, source = load_roads(max_retries=max_retries)
+    index = RoadSegmentIndex(roads)
+    _road_index, _road_index_source, _road_index_built_at = index, source, time.monotonic()
+    print(f"Road index built with {len(index)} segments from {source} data")
+    if source == 'static':
+        print("Road index is serving static file data until the database has roads")
+    return index
+
+
+def rebuild_road_index(max_retries=3):
+    """Rebuild the shared road index from the current road data"""
+    with _road_index_build_lock:
+        return _build_road_index(max_retries)
+
+
+def _retry_database_index():
+    """Rebuild a static-file index in the background, at most one attempt at a time"""
+    if not _road_index_retry_lock.acquire(blocking=False):
+        return
+    try:
+        with _road_index_build_lock:
+            # Another rebuild may have loaded the database while we waited
+            if _road_index_source == 'static':
+                _build_road_index()
+    except Exception as e:
+        print(f"Error rebuilding road index: {e}")
+    finally:
+        _road_index_retry_lock.release()
+
+
+def get_road_index():
+    """
+    Get the shared road index, building it on first use
+
+    An index built from the static file is served as is, while the database
+    is retried in the background every STATIC_INDEX_RETRY_SECONDS.
+    """
+    global _road_index_built_at
+    if _road_index is None:
+        with _road_index_lock:
+            if _road_index is None:
+                rebuild_road_index()
+    elif _road_index_source == 'static' and time.monotonic() - _road_index_built_at > STATIC_INDEX_RETRY_SECONDS:
+        _road_index_built_at = time.monotonic()  # Don't start another retry on the next request
+        threading.Thread(target=_retry_database_index, daemon=True).start()
+    return _road_index
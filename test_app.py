@@ -0,0 +1,121 @@
+import pytest
+import app as app_module
+
+
+class FakeIndex:
+    """Stands in for the road index, recording what the endpoints ask it"""
+
+    def __init__(self):
+        self.calls = []
+
+    def query(self, lat, lon, k=1, max_distance=None):
+        self.calls.append(('query', lat, lon, k, max_distance))
+        return [{'osm_id': 1, 'name': 'Main Street', 'road_type': 'primary', 'distance_m': 1.0,
+                 'point': {'lat': lat, 'lon': lon}}]
+
+    def query_many(self, lats, lons, k=1, max_distance=None):
+        self.calls.append(('query_many', list(lats), list(lons), k, max_distance))
+        return [[] for _ in lats]
+
+
+@pytest.fixture
+def index(monkeypatch):
+    fake = FakeIndex()
+    monkeypatch.setattr(app_module, 'get_road_index', lambda: fake)
+    return fake
+
+
+@pytest.fixture
+def client():
+    return app_module.app.test_client()
+
+
+def test_nearest(client, index):
+    response = client.get('/nearest?lat=41.65&lon=-83.55&k=3&max_distance=250')
+    assert response.status_code == 200
+    assert response.get_json()['matches'][0]['osm_id'] == 1
+    assert index.calls == [('query', 41.65, -83.55, 3, 250.0)]
+
+
+def test_nearest_defaults(client, index):
+    assert client.get('/nearest?lat=41.65&lon=-83.55').status_code == 200
+    assert index.calls == [('query', 41.65, -83.55, 1, None)]
+
+
+@pytest.mark.parametrize('query', [
+    'lon=-83.55',
+    'lat=41.65',
+    'lat=abc&lon=-83.55',
+    'lat=nan&lon=-83.55',
+    'lat=41.65&lon=inf',
+    'lat=90.5&lon=-83.55',
+    'lat=41.65&lon=-180.5',
+    'lat=1e300&lon=-83.55',
+    'lat=41.65&lon=-83.55&k=0',
+    f'lat=41.65&lon=-83.55&k={app_module.MAX_NEAREST_K + 1}',
+    'lat=41.65&lon=-83.55&k=2.9',
+    'lat=41.65&lon=-83.55&max_distance=0',
+    'lat=41.65&lon=-83.55&max_distance=-5',
+    'lat=41.65&lon=-83.55&max_distance=nan',
+    'lat=41.65&lon=-83.55&max_distance=inf',
+])
+def test_nearest_rejects_invalid_parameters(client, index, query):
+    response = client.get(f'/nearest?{query}')
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+    assert index.calls == []
+
+
+def test_nearest_batch_accepts_both_point_shapes(client, index):
+    response = client.post('/nearest/batch', json={
+        'points': [[41.65, -83.55], {'lat': 41.7, 'lon': -83.6}],
+        'k': 2,
+        'max_distance': 100
+    })
+    assert response.status_code == 200
+    assert response.get_json() == {'results': [
+        {'lat': 41.65, 'lon': -83.55, 'matches': []},
+        {'lat': 41.7, 'lon': -83.6, 'matches': []}
+    ]}
+    assert index.calls == [('query_many', [41.65, 41.7], [-83.55, -83.6], 2, 100.0)]
+
+
+def test_nearest_batch_enforces_point_limit(client, index, monkeypatch):
+    monkeypatch.setattr(app_module, 'MAX_BATCH_POINTS', 3)
+    assert client.post('/nearest/batch', json={'points': [[41.65, -83.55]] * 3}).status_code == 200
+    assert client.post('/nearest/batch', json={'points': [[41.65, -83.55]] * 4}).status_code == 400
+    assert len(index.calls) == 1
+
+
+@pytest.mark.parametrize('body', [
+    {},
+    {'points': 5},
+    {'points': [[41.65]]},
+    {'points': [{'lat': 41.65}]},
+    {'points': [[float('nan'), -83.55]]},
+    {'points': [[41.65, float('inf')]]},
+    {'points': [[91, -83.55]]},
+    {'points': [[41.65, 181]]},
+    {'points': [[10 ** 400, 0]]},
+    {'points': [[41.65, -83.55]], 'k': 0},
+    {'points': [[41.65, -83.55]], 'k': app_module.MAX_NEAREST_K + 1},
+    {'points': [[41.65, -83.55]], 'k': 2.9},
+    {'points': [[41.65, -83.55]], 'k': True},
+    {'points': [[41.65, -83.55]], 'max_distance': 0},
+    {'points': [[41.65, -83.55]], 'max_distance': 'nan'},
+    {'points': [[41.65, -83.55]], 'max_distance': float('inf')},
+    {'points': [[41.65, -83.55]], 'max_distance': True},
+    {'points': [[41.65, -83.55]], 'max_distance': 10 ** 400},
+])
+def test_nearest_batch_rejects_invalid_body(client, index, body):
+    response = client.post('/nearest/batch', json=body)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+    assert index.calls == []
+
+
+@pytest.mark.parametrize('data', ['[[41.65, -83.55]]', '"points"', '5', 'null', 'not json'])
+def test_nearest_batch_rejects_non_object_body(client, index, data):
+    response = client.post('/nearest/batch', data=data, content_type='application/json')
+    assert response.status_code == 400
+    assert index.calls == []
@@ -0,0 +1,189 @@
+import math
+import random
+import threading
+import pytest
+import road_index
+from road_index import RoadSegmentIndex
+
+
+JUNCTION = (41.7, -83.35)
+
+
+def make_roads(seed=0, count=60):
+    """
+    Random polylines around Toledo, some starting on another road's node,
+    plus a junction, a degenerate and a single-node road
+    """
+    rng = random.Random(seed)
+    roads = []
+    for osm_id in range(1, count + 1):
+        if roads and osm_id % 3 == 0:
+            # Share a node with an earlier road, as roads meeting at junctions do
+            node = rng.choice(rng.choice(roads)['geometry'])
+            lat, lon = node['lat'], node['lon']
+        else:
+            lat, lon = rng.uniform(41.55, 41.75), rng.uniform(-83.7, -83.4)
+        geometry = []
+        for _ in range(rng.randint(2, 6)):
+            geometry.append({'lat': lat, 'lon': lon})
+            lat += rng.uniform(-0.01, 0.01)
+            lon += rng.uniform(-0.01, 0.01)
+        roads.append({'osm_id': osm_id, 'name': f'Road {osm_id}', 'road_type': 'primary', 'geometry': geometry})
+    # Two roads leaving one node north and east: points south-west of it are
+    # exactly equally close to both, at the node
+    for osm_id, (dlat, dlon) in enumerate([(0.01, 0), (0, 0.01)], start=500):
+        roads.append({
+            'osm_id': osm_id, 'name': f'Junction {osm_id}', 'road_type': 'primary',
+            'geometry': [{'lat': JUNCTION[0], 'lon': JUNCTION[1]}, {'lat': JUNCTION[0] + dlat, 'lon': JUNCTION[1] + dlon}]
+        })
+    # Zero-length segment: both nodes at the same place
+    roads.append({
+        'osm_id': 1000, 'name': 'Stub', 'road_type': 'secondary',
+        'geometry': [{'lat': 41.8, 'lon': -83.3}, {'lat': 41.8, 'lon': -83.3}]
+    })
+    # Too short to form a segment, must be skipped
+    roads.append({'osm_id': 1001, 'name': 'Dot', 'road_type': 'secondary', 'geometry': [{'lat': 41.6, 'lon': -83.5}]})
+    return roads
+
+
+def brute_force(index, roads, lat, lon, k, max_distance=None):
+    """Distances to the k nearest roads, measuring every segment of every road"""
+    px, py = index._project(lat, lon)
+    nearest = {}
+    for road in roads:
+        points = [index._project(node['lat'], node['lon']) for node in road['geometry']]
+        for (ax, ay), (bx, by) in zip(points, points[1:]):
+            dx, dy = bx - ax, by - ay
+            len2 = dx * dx + dy * dy
+            t = 0.0 if len2 == 0 else min(max(((px - ax) * dx + (py - ay) * dy) / len2, 0.0), 1.0)
+            dist = math.hypot(px - (ax + t * dx), py - (ay + t * dy))
+            nearest[road['osm_id']] = min(dist, nearest.get(road['osm_id'], math.inf))
+    dists = sorted(nearest.values())[:k]
+    return [d for d in dists if max_distance is None or d <= max_distance]
+
+
+def make_points(roads, seed=1, count=150):
+    rng = random.Random(seed)
+    points = [(rng.uniform(41.5, 41.85), rng.uniform(-83.8, -83.25)) for _ in range(count)]
+    # Around shared nodes, where several roads tie for nearest
+    nodes = [node for road in roads for node in road['geometry']]
+    for node in rng.sample(nodes, 50):
+        points.append((node['lat'] + rng.uniform(-0.002, 0.002), node['lon'] + rng.uniform(-0.002, 0.002)))
+    points += [(JUNCTION[0] + 0.001, JUNCTION[1] + 0.001), (JUNCTION[0] - 0.001, JUNCTION[1] - 0.001)]
+    # Off the grid: just outside the data, and far away
+    points += [(41.4, -83.9), (42.2, -83.0), (0.0, 0.0), (45.0, -80.0)]
+    return points
+
+
+@pytest.fixture(scope='module')
+def roads():
+    return make_roads()
+
+
+@pytest.mark.parametrize('cell_size', [100.0, 500.0, 2000.0])
+@pytest.mark.parametrize('k', [1, 3, 5])
+@pytest.mark.parametrize('max_distance', [None, 400.0])
+def test_query_matches_brute_force(roads, cell_size, k, max_distance):
+    index = RoadSegmentIndex(roads, cell_size=cell_size)
+    for lat, lon in make_points(roads):
+        expected = brute_force(index, roads, lat, lon, k, max_distance)
+        got = [m['distance_m'] for m in index.query(lat, lon, k=k, max_distance=max_distance)]
+        assert got == pytest.approx(expected, abs=0.01)
+
+
+@pytest.mark.parametrize('k', [1, 3])
+@pytest.mark.parametrize('max_distance', [None, 400.0])
+def test_query_many_matches_brute_force(roads, monkeypatch, k, max_distance):
+    # Small chunks so the batch is split across several of them
+    monkeypatch.setattr(road_index, 'BATCH_CHUNK_POINTS', 16)
+    index = RoadSegmentIndex(roads)
+    points = make_points(roads)
+    results = index.query_many([p[0] for p in points], [p[1] for p in points], k=k, max_distance=max_distance)
+    assert len(results) == len(points)
+    for (lat, lon), matches in zip(points, results):
+        expected = brute_force(index, roads, lat, lon, k, max_distance)
+        assert [m['distance_m'] for m in matches] == pytest.approx(expected, abs=0.01)
+        assert matches == index.query(lat, lon, k=k, max_distance=max_distance)
+
+
+def test_ties_break_on_road_order(roads):
+    index = RoadSegmentIndex(roads)
+    lat, lon = JUNCTION[0] - 0.001, JUNCTION[1] - 0.001
+    matches = index.query(lat, lon, k=2)
+    assert matches[0]['distance_m'] == matches[1]['distance_m']
+    assert [m['osm_id'] for m in matches] == [500, 501]
+    assert matches[0]['point'] == matches[1]['point'] == pytest.approx({'lat': JUNCTION[0], 'lon': JUNCTION[1]})
+    assert index.query_many([lat], [lon], k=2) == [matches]
+    assert index.query_many([lat], [lon], k=1) == [matches[:1]] == [index.query(lat, lon, k=1)]
+
+
+def test_degenerate_segment(roads):
+    index = RoadSegmentIndex(roads)
+    match, = index.query(41.8001, -83.3, k=1)
+    assert match['osm_id'] == 1000
+    assert match['distance_m'] == pytest.approx(11.12, abs=0.01)
+    assert match['point'] == pytest.approx({'lat': 41.8, 'lon': -83.3})
+    assert all(road['osm_id'] != 1001 for road in index.roads)
+
+
+def test_empty_index():
+    index = RoadSegmentIndex([])
+    assert len(index) == 0
+    assert index.query(41.65, -83.55) == []
+    assert index.query_many([41.65, 41.7], [-83.55, -83.6]) == [[], []]
+
+
+def test_empty_batch(roads):
+    assert RoadSegmentIndex(roads).query_many([], []) == []
+
+
+def test_long_segment_buckets_cells_along_it(roads):
+    diagonal = {
+        'osm_id': 2000, 'name': 'Diagonal', 'road_type': 'motorway',
+        'geometry': [{'lat': 41.3, 'lon': -84.0}, {'lat': 42.0, 'lon': -83.0}]
+    }
+    index = RoadSegmentIndex(roads + [diagonal], cell_size=100.0)
+    # Bucketing by bounding box would add ~650,000 cells for the diagonal alone
+    assert index._cell_segs.size - RoadSegmentIndex(roads, cell_size=100.0)._cell_segs.size < 5000
+    match, = index.query(41.65, -83.5)
+    assert match['osm_id'] == 2000
+    assert match['distance_m'] == pytest.approx(0.0, abs=0.01)
+
+
+def test_background_retry_cannot_overwrite_newer_rebuild(roads, monkeypatch):
+    retry_loading = threading.Event()
+    release_retry = threading.Event()
+
+    def fake_load_roads(max_retries=3):
+        if threading.current_thread().name == 'retry':
+            # Database still down when the retry reads it
+            retry_loading.set()
+            release_retry.wait(5)
+            return [], 'static'
+        return roads, 'database'
+
+    monkeypatch.setattr(road_index, 'load_roads', fake_load_roads)
+    monkeypatch.setattr(road_index, '_road_index', RoadSegmentIndex([]))
+    monkeypatch.setattr(road_index, '_road_index_source', 'static')
+
+    retry = threading.Thread(target=road_index._retry_database_index, name='retry')
+    retry.start()
+    assert retry_loading.wait(5)
+    # An OSM update finishes while the retry is still loading
+    update = threading.Thread(target=road_index.rebuild_road_index)
+    update.start()
+    # Gives the update time to publish first, unless it waits for the retry
+    update.join(0.5)
+    release_retry.set()
+    retry.join(5)
+    update.join(5)
+
+    assert road_index._road_index_source == 'database'
+    assert len(road_index.get_road_index()) == len(RoadSegmentIndex(roads))
+
+
+def test_background_retry_skips_database_index(roads, monkeypatch):
+    monkeypatch.setattr(road_index, 'load_roads', lambda max_retries=3: pytest.fail('index was rebuilt'))
+    monkeypatch.setattr(road_index, '_road_index', RoadSegmentIndex(roads))
+    monkeypatch.setattr(road_index, '_road_index_source', 'database')
+    road_index._retry_database_index()